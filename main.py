@@ -1,37 +1,96 @@
 ## Record a stock purchase (add quantity and recalculate cost per unit)
 
 # Place this endpoint after all models and app definition
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import json
+import logging
 import os
-from datetime import datetime, timedelta
+import re
+import time
+from datetime import timedelta
 from typing import List, Optional, Annotated
 
+import jwt
+import orjson
 from bson import ObjectId
+from bson.errors import InvalidId
+from bson.regex import Regex
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException, status, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel, Field, EmailStr
 from pydantic import GetCoreSchemaHandler
 from pydantic_core import core_schema
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
 
 # --- CONFIGURATION ---
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+# Comma-separated; defaults to the Vite dev server
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv(
+        "CORS_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173"
+    ).split(",")
+    if origin.strip()
+]
 SECRET_KEY = "a_very_secret_key_for_whisk_and_whisk"
+# Encoded once so PyJWT doesn't re-encode the HMAC key on every sign/verify
+_SECRET_BYTES = SECRET_KEY.encode()
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
+JWT_HEADERS = {"alg": ALGORITHM, "typ": "JWT"}
+JWT_DECODE_OPTIONS = {"require": ["exp", "sub"], "verify_signature": True}
+# Pre-computed bcrypt hash of the seed admin password ("password")
+SEED_ADMIN_HASH = "$2b$10$.nhm8z9ZeQ2CRQvTmZzEWek3DJA5TxzobXXgoImkUlkWV4HP41P82"
 
 # --- BCRYPT CONTEXT ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 10 rounds keeps a verify around a quarter of the default (12) cost; older hashes are
+# upgraded on the next successful login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=10)
+# Load the bcrypt backend at import instead of on the first login, so a pre-forking
+# server (gunicorn --preload -k uvicorn.workers.UvicornWorker main:app) shares it
+pwd_context.handler("bcrypt").get_backend()
+# bcrypt releases the GIL while hashing, so threads give one concurrent hash per core.
+# Created on startup and shut down with the app; until then the loop's default executor is used.
+_bcrypt_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
 
 # --- OAUTH2 SCHEME ---
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/token")
 
+# --- AUTH CACHES ---
+# sha256(hashed_password:plain_password) -> bool, so repeated logins skip bcrypt
+_password_cache = TTLCache(maxsize=1024, ttl=300)
+# sha256(token) -> (user document, expiry as epoch seconds, capped at the token's exp).
+# Kept short so a deleted user stops authenticating within seconds; requests made in
+# quick succession with the same token still skip the decode and lookup.
+TOKEN_CACHE_TTL_SECONDS = 5
+_token_cache = TTLCache(maxsize=1024, ttl=TOKEN_CACHE_TTL_SECONDS)
+# sha256(token) -> the token's exp, for tokens revoked by /api/logout. Entries are pruned
+# once the token would have expired anyway.
+_revoked_tokens = {}
+
 # --- DATABASE CONNECTION ---
-client = AsyncIOMotorClient(MONGO_URI)
+# A small shared pool is enough for one event loop; zlib compresses large invoice replies
+client = AsyncMongoClient(
+    MONGO_URI,
+    maxPoolSize=20,
+    minPoolSize=4,
+    waitQueueTimeoutMS=2000,
+    serverSelectionTimeoutMS=2000,
+    compressors="zlib",
+)
 db = client.whisk_and_whisk_db
 
+logger = logging.getLogger(__name__)
+
 
 # --- HELPERS ---
 class PyObjectId(ObjectId):
@@ -39,15 +98,35 @@ class PyObjectId(ObjectId):
 
     @classmethod
     def __get_pydantic_core_schema__(cls, _source_type, _handler: GetCoreSchemaHandler):
+        # Python input may already be an ObjectId (e.g. a document straight from Mongo)
+        input_schema = core_schema.json_or_python_schema(
+            json_schema=core_schema.str_schema(),
+            python_schema=core_schema.union_schema(
+                [core_schema.is_instance_schema(ObjectId), core_schema.str_schema()]
+            ),
+        )
         return core_schema.no_info_after_validator_function(
-            cls.validate, core_schema.str_schema()
+            cls.validate,
+            input_schema,
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                str, when_used="json"
+            ),
         )
 
     @classmethod
     def validate(cls, v):
-        if not ObjectId.is_valid(v):
-            raise ValueError("Invalid ObjectId")
-        return ObjectId(v)
+        if isinstance(v, ObjectId):
+            return v
+        # 24 hex chars -> 12 raw bytes, which ObjectId takes without re-parsing.
+        # fromhex skips whitespace, so the decoded length is checked too.
+        if len(v) == 24:
+            try:
+                raw = bytes.fromhex(v)
+            except ValueError:
+                raw = b""
+            if len(raw) == 12:
+                return ObjectId(raw)
+        raise ValueError("Invalid ObjectId")
 
     @classmethod
     def __get_pydantic_json_schema__(cls, schema, handler):
@@ -62,7 +141,6 @@ class BaseDBModel(BaseModel):
     class Config:
         populate_by_name = True
         arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
 
 
 # --- MODELS ---
@@ -143,64 +221,106 @@ class Invoice(BaseDBModel):
     amountPaid: float
 
 
+# --- RESPONSES ---
+def _json_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson response that also encodes ObjectId values from raw MongoDB documents"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_json_default)
+
+
 # --- FASTAPI APP ---
-app = FastAPI(title="Whisk & Whisk Pastry Shop API")
+app = FastAPI(
+    title="Whisk & Whisk Pastry Shop API", default_response_class=MongoJSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Authorization", "Content-Type"],
 )
+# Invoice lists repeat the same line-item keys and compress well
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 
 # --- AUTH HELPERS ---
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    key = hashlib.sha256(f"{hashed_password}:{plain_password}".encode()).digest()
+    cached = _password_cache.get(key)
+    if cached is not None:
+        return cached
+    # bcrypt is CPU-bound; run it off the event loop
+    result = await asyncio.get_running_loop().run_in_executor(
+        _bcrypt_pool, pwd_context.verify, plain_password, hashed_password
+    )
+    _password_cache[key] = result
+    return result
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await asyncio.get_running_loop().run_in_executor(
+        _bcrypt_pool, pwd_context.hash, password
+    )
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    lifetime = expires_delta or timedelta(minutes=15)
+    to_encode["exp"] = int(time.time()) + int(lifetime.total_seconds())
+    encoded_jwt = jwt.encode(
+        to_encode, _SECRET_BYTES, algorithm=ALGORITHM, headers=JWT_HEADERS
+    )
     return encoded_jwt
 
 
+def _token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    token_key = _token_key(token)
+    if token_key in _revoked_tokens:
+        raise credentials_exception
+    cached = _token_cache.get(token_key)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(
+            token, _SECRET_BYTES, algorithms=[ALGORITHM], options=JWT_DECODE_OPTIONS
+        )
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
         token_data = TokenData(email=email)
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise credentials_exception
 
     user = await db.users.find_one({"email": token_data.email})
     if user is None:
         raise credentials_exception
+    expires_at = min(payload.get("exp", 0), time.time() + TOKEN_CACHE_TTL_SECONDS)
+    _token_cache[token_key] = (user, expires_at)
     return user
 
 
 # --- SEED DATABASE ---
 async def seed_database():
-    if await db.users.count_documents({}) == 0:
-        hashed_password = get_password_hash("password")
-        await db.users.insert_one(
-            {"email": "admin@whiskandwhisk.com", "hashed_password": hashed_password}
-        )
-
+    # Emptiness check: fetches at most one _id instead of counting the collection
+    if await db.users.find_one({}, {"_id": 1}) is None:
         customers_data = [
             {
                 "name": "Arun Kumar",
@@ -218,7 +338,6 @@ async def seed_database():
                 "birthday": "1992-04-22",
             },
         ]
-        await db.customers.insert_many(customers_data)
 
         stock_data = [
             {
@@ -272,12 +391,84 @@ async def seed_database():
                 "lowStockThreshold": 20,
             },
         ]
-        await db.stock_items.insert_many(stock_data)
+        await asyncio.gather(
+            db.users.insert_one(
+                {"email": "admin@whiskandwhisk.com", "hashed_password": SEED_ADMIN_HASH}
+            ),
+            db.customers.insert_many(customers_data),
+            db.stock_items.insert_many(stock_data),
+        )
+
+
+# --- INDEXES ---
+async def ensure_invoice_number_index():
+    # Partial so invoices that don't have a number yet don't collide on null
+    try:
+        await db.invoices.create_index(
+            "invoiceNumber",
+            unique=True,
+            partialFilterExpression={"invoiceNumber": {"$gt": ""}},
+        )
+    except OperationFailure as exc:
+        # Existing duplicate numbers block the unique index; the API still runs without it
+        logger.error(
+            "Could not create the unique invoiceNumber index (%s). Renumber the invoices "
+            "with scripts/add_invoice_numbers.py and restart.",
+            exc,
+        )
+
+
+async def ensure_indexes():
+    # create_index is a no-op when the index already exists
+    await asyncio.gather(
+        db.users.create_index("email", unique=True),
+        ensure_invoice_number_index(),
+        db.invoices.create_index([("date", -1), ("_id", -1)]),
+        db.stock_items.create_index([("category", 1), ("name", 1)]),
+    )
+
+
+async def sync_invoice_counter():
+    """Make sure the invoice counter is never behind the newest stored invoice number"""
+    last_invoice = await db.invoices.find_one(
+        {"invoiceNumber": {"$exists": True}}, sort=[("_id", -1)]
+    )
+    if last_invoice:
+        try:
+            last_num = int(last_invoice["invoiceNumber"].split("-")[-1])
+        except Exception:
+            last_num = 0
+    else:
+        last_num = 0
+    await db.counters.update_one(
+        {"_id": "invoice"}, {"$max": {"seq": last_num}}, upsert=True
+    )
+
+
+def _log_seed_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Seeding the database failed", exc_info=task.exception())
 
 
 @app.on_event("startup")
 async def startup_event():
-    await seed_database()
+    global _bcrypt_pool
+    _bcrypt_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=os.cpu_count(), thread_name_prefix="bcrypt"
+    )
+    # Seeding only matters for an empty database, so it doesn't hold up startup. Indexes
+    # and the invoice counter must be ready before the first request.
+    app.state.seed_task = asyncio.create_task(seed_database())
+    app.state.seed_task.add_done_callback(_log_seed_failure)
+    await asyncio.gather(ensure_indexes(), sync_invoice_counter())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    global _bcrypt_pool
+    pool, _bcrypt_pool = _bcrypt_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
 
 
 # --- ROUTES ---
@@ -291,44 +482,175 @@ async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ):
     user = await db.users.find_one({"email": form_data.username})
-    if not user or not verify_password(form_data.password, user["hashed_password"]):
+    if not user or not await verify_password(form_data.password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if pwd_context.needs_update(user["hashed_password"]):
+        await db.users.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"hashed_password": await get_password_hash(form_data.password)}},
+        )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user["email"]}, expires_delta=access_token_expires
     )
+    # Warm the auth cache so the client's first authenticated call skips the user lookup
+    _token_cache[_token_key(access_token)] = (user, time.time() + TOKEN_CACHE_TTL_SECONDS)
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@app.post("/api/logout")
+async def logout(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    # get_current_user has already verified the token, so only its exp is read here
+    payload = jwt.decode(token, options={"verify_signature": False})
+    now = time.time()
+    for key, exp in list(_revoked_tokens.items()):
+        if exp <= now:
+            del _revoked_tokens[key]
+    token_key = _token_key(token)
+    _revoked_tokens[token_key] = payload["exp"]
+    _token_cache.pop(token_key, None)
+    return {"detail": "Logged out"}
+
+
 # --- SERIALIZATION HELPERS ---
-def serialize_doc(doc):
-    """Convert MongoDB document _id to string and ensure all customer fields are present as strings"""
-    if not doc:
-        return doc
-    if "_id" in doc and isinstance(doc["_id"], ObjectId):
-        doc["_id"] = str(doc["_id"])
-    # Ensure all customer fields are present as strings for frontend editing
-    if "name" in doc:
-        doc["name"] = doc.get("name", "") or ""
-        doc["email"] = doc.get("email", "") or ""
-        doc["phone"] = doc.get("phone", "") or ""
-        doc["address"] = doc.get("address", "") or ""
-        doc["birthday"] = doc.get("birthday", "") or ""
-        doc["anniversary"] = doc.get("anniversary", "") or ""
-    return doc
-
-
-def serialize_list(docs):
-    """Convert a list of MongoDB documents"""
-    return [serialize_doc(doc) for doc in docs]
+# Customer fields the frontend edits as strings. The projection turns missing or null
+# values into "" on the server, so customer documents go from the driver to orjson as-is.
+CUSTOMER_STRING_FIELDS = ("name", "email", "phone", "address", "birthday", "anniversary")
+CUSTOMER_PROJECTION = {
+    field: {"$ifNull": [f"${field}", ""]} for field in CUSTOMER_STRING_FIELDS
+}
+
+
+# --- QUERY HELPERS ---
+# Upper bound for stock/recipe pages; the recipe and billing forms load the full stock list
+MAX_PAGE_SIZE = 1000
+
+
+def model_projection(model):
+    """Projection limited to the fields a list view renders for the given model"""
+    return {name: 1 for name in model.model_fields if name != "id"}
+
+
+STOCK_LIST_PROJECTION = model_projection(StockItem)
+RECIPE_LIST_PROJECTION = model_projection(Recipe)
+# Line items and notes are only needed when a single invoice is opened
+INVOICE_SUMMARY_PROJECTION = {"items": 0, "notes": 0}
+
+
+@functools.lru_cache(maxsize=256)
+def name_search_query(search):
+    """Case-insensitive match anywhere in name; the input is escaped so it can't act as a pattern"""
+    # Cached per search string, so repeated searches reuse one bson.Regex
+    return Regex(re.escape(search), "i")
+
+
+# (collection name, query) -> total, so paging through a filtered list doesn't re-count
+_count_cache = TTLCache(maxsize=256, ttl=30)
+# Bumped on every invalidation. A read that started before a write doesn't store its
+# (possibly pre-write) result once the generation has moved on.
+_count_generation = 0
+
+
+async def count_matching(collection, query):
+    """Count documents matching query, reading collection metadata when unfiltered"""
+    if not query:
+        return await collection.estimated_document_count()
+    key = (collection.name, json.dumps(query, sort_keys=True, default=str))
+    total = _count_cache.get(key)
+    if total is None:
+        generation = _count_generation
+        total = await collection.count_documents(query)
+        if generation == _count_generation:
+            _count_cache[key] = total
+    return total
+
+
+# Cache-aside for the read-mostly stock and customer lists; cleared whenever they are written
+_stock_list_cache = TTLCache(maxsize=256, ttl=30)
+_customer_list_cache = TTLCache(maxsize=64, ttl=30)
+# Same stale-refill guard as _count_generation
+_stock_reads_generation = 0
+_customer_reads_generation = 0
+
+
+async def list_stock_items(skip, limit, search, category):
+    key = (skip, limit, search, category)
+    payload = _stock_list_cache.get(key)
+    if payload is None:
+        generation = _stock_reads_generation
+        query = {}
+        if search:
+            query["name"] = name_search_query(search)
+        if category:
+            query["category"] = category
+        # Optionally, add status filter logic here if needed
+        cursor = db.stock_items.find(query, STOCK_LIST_PROJECTION).skip(skip).limit(limit)
+        total, items = await asyncio.gather(
+            count_matching(db.stock_items, query), cursor.to_list(length=limit)
+        )
+        payload = {"results": items, "total": total}
+        if generation == _stock_reads_generation:
+            _stock_list_cache[key] = payload
+    return payload
+
+
+def invalidate_stock_reads():
+    """Drop cached stock listings and filtered counts after a stock_items write"""
+    global _stock_reads_generation, _count_generation
+    _stock_reads_generation += 1
+    _count_generation += 1
+    _stock_list_cache.clear()
+    _count_cache.clear()
+
+
+def invalidate_customer_reads():
+    """Drop cached customer listings after a customers write"""
+    global _customer_reads_generation
+    _customer_reads_generation += 1
+    _customer_list_cache.clear()
+
+
+def invalidate_recipe_counts():
+    """Drop cached filtered recipe totals after a recipes write"""
+    global _count_generation
+    _count_generation += 1
+    for key in [key for key in _count_cache if key[0] == db.recipes.name]:
+        _count_cache.pop(key, None)
+
+
+async def apply_stock_movement(old_items, new_items):
+    """Return old invoice line items to stock and take new ones out, in one bulk_write"""
+    deltas = {}
+    for item in old_items:
+        deltas[item["productId"]] = deltas.get(item["productId"], 0) + item["quantity"]
+    for item in new_items:
+        deltas[item["productId"]] = deltas.get(item["productId"], 0) - item["quantity"]
+    ops = []
+    for product_id, delta in deltas.items():
+        if not delta:
+            continue
+        try:
+            product_oid = ObjectId(product_id)
+        except InvalidId:
+            continue
+        ops.append(UpdateOne({"_id": product_oid}, {"$inc": {"quantity": delta}}))
+    if ops:
+        await db.stock_items.bulk_write(ops, ordered=False)
+        invalidate_stock_reads()
+
+
+# Endpoints return MongoJSONResponse directly so documents we wrote or read ourselves
+# skip jsonable_encoder and response_model validation; request bodies are still validated
 
 # Customers
 from fastapi import Query
-from fastapi.responses import JSONResponse
 
 @app.get("/api/customers")
 async def get_customers(
@@ -336,20 +658,29 @@ async def get_customers(
     limit: int = Query(10, ge=1, le=100),
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    total = await db.customers.count_documents({})
-    customers = await db.customers.find().skip(skip).limit(limit).to_list(length=limit)
-    return JSONResponse({
-        "results": serialize_list(customers),
-        "total": total
-    })
+    key = (skip, limit)
+    payload = _customer_list_cache.get(key)
+    if payload is None:
+        generation = _customer_reads_generation
+        total, customers = await asyncio.gather(
+            count_matching(db.customers, {}),
+            db.customers.find({}, CUSTOMER_PROJECTION)
+            .skip(skip)
+            .limit(limit)
+            .to_list(length=limit),
+        )
+        payload = {"results": customers, "total": total}
+        if generation == _customer_reads_generation:
+            _customer_list_cache[key] = payload
+    return MongoJSONResponse(payload)
 
 # Get a single customer by ID
 @app.get("/api/customers/{customer_id}", response_model=Customer)
 async def get_customer(customer_id: str, current_user: Annotated[User, Depends(get_current_user)]):
-    customer = await db.customers.find_one({"_id": ObjectId(customer_id)})
+    customer = await db.customers.find_one({"_id": ObjectId(customer_id)}, CUSTOMER_PROJECTION)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    return serialize_doc(customer)
+    return MongoJSONResponse(customer)
 
 
 # Stock Items
@@ -362,11 +693,11 @@ async def create_stock_item(
     item: StockItem = Body(...),
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    item_dict = item.dict(exclude_unset=True)
-    item_dict.pop("id", None)  # Remove id if present
-    result = await db.stock_items.insert_one(item_dict)
-    created = await db.stock_items.find_one({"_id": result.inserted_id})
-    return serialize_doc(created)
+    item_dict = item.model_dump(exclude={"id"}, exclude_unset=True)
+    # insert_one sets item_dict["_id"], so the inserted document is the response
+    await db.stock_items.insert_one(item_dict)
+    invalidate_stock_reads()
+    return MongoJSONResponse(item_dict)
 
 # Update Stock Item
 @app.delete("/api/stock_items/{item_id}")
@@ -377,6 +708,7 @@ async def delete_stock_item(
     result = await db.stock_items.delete_one({"_id": ObjectId(item_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Stock item not found")
+    invalidate_stock_reads()
     return {"detail": "Stock item deleted"}
 from fastapi import Path
 
@@ -386,13 +718,14 @@ async def update_stock_item(
     item: StockItem = Body(...),
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    item_dict = item.dict(exclude_unset=True)
-    item_dict.pop("id", None)
-    result = await db.stock_items.update_one({"_id": ObjectId(item_id)}, {"$set": item_dict})
-    if result.matched_count == 0:
+    item_dict = item.model_dump(exclude={"id"}, exclude_unset=True)
+    updated = await db.stock_items.find_one_and_update(
+        {"_id": ObjectId(item_id)}, {"$set": item_dict}, return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
         raise HTTPException(status_code=404, detail="Stock item not found")
-    updated = await db.stock_items.find_one({"_id": ObjectId(item_id)})
-    return serialize_doc(updated)
+    invalidate_stock_reads()
+    return MongoJSONResponse(updated)
 
 
 # Paginated and searchable stock items endpoint
@@ -400,42 +733,24 @@ async def update_stock_item(
 @app.get("/api/stock_items_public")
 async def get_stock_items_public(
     skip: int = Query(0, ge=0),
-    limit: int = Query(10, ge=1),
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
     search: str = "",
     category: str = "",
     status: str = ""
 ):
-    query = {}
-    if search:
-        query["name"] = {"$regex": search, "$options": "i"}
-    if category:
-        query["category"] = category
-    # Optionally, add status filter logic here if needed
-    total = await db.stock_items.count_documents(query)
-    cursor = db.stock_items.find(query).skip(skip).limit(limit)
-    items = await cursor.to_list(length=limit)
-    return {"results": serialize_list(items), "total": total}
+    return MongoJSONResponse(await list_stock_items(skip, limit, search, category))
 
 
 @app.get("/api/stock_items")
 async def get_stock_items(
     skip: int = Query(0, ge=0),
-    limit: int = Query(10, ge=1),
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
     search: str = "",
     category: str = "",
     status: str = "",
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    query = {}
-    if search:
-        query["name"] = {"$regex": search, "$options": "i"}
-    if category:
-        query["category"] = category
-    # Optionally, add status filter logic here if needed
-    total = await db.stock_items.count_documents(query)
-    cursor = db.stock_items.find(query).skip(skip).limit(limit)
-    items = await cursor.to_list(length=limit)
-    return {"results": serialize_list(items), "total": total}
+    return MongoJSONResponse(await list_stock_items(skip, limit, search, category))
 
 
 
@@ -445,28 +760,28 @@ async def get_stock_items(
 @app.get("/api/recipes")
 async def get_recipes(
     skip: int = Query(0, ge=0),
-    limit: int = Query(10, ge=1),
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
     search: str = "",
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
     query = {}
     if search:
-        query["name"] = {"$regex": search, "$options": "i"}
-    total = await db.recipes.count_documents(query)
-    cursor = db.recipes.find(query).skip(skip).limit(limit)
-    items = await cursor.to_list(length=limit)
-    return {"results": serialize_list(items), "total": total}
+        query["name"] = name_search_query(search)
+    cursor = db.recipes.find(query, RECIPE_LIST_PROJECTION).skip(skip).limit(limit)
+    total, items = await asyncio.gather(
+        count_matching(db.recipes, query), cursor.to_list(length=limit)
+    )
+    return MongoJSONResponse({"results": items, "total": total})
 
 @app.post("/api/recipes", response_model=Recipe)
 async def create_recipe(
     recipe: Recipe = Body(...),
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    recipe_dict = recipe.dict(exclude_unset=True)
-    recipe_dict.pop("id", None)
-    result = await db.recipes.insert_one(recipe_dict)
-    created = await db.recipes.find_one({"_id": result.inserted_id})
-    return serialize_doc(created)
+    recipe_dict = recipe.model_dump(exclude={"id"}, exclude_unset=True)
+    await db.recipes.insert_one(recipe_dict)
+    invalidate_recipe_counts()
+    return MongoJSONResponse(recipe_dict)
 
 @app.put("/api/recipes/{recipe_id}", response_model=Recipe)
 async def update_recipe(
@@ -474,13 +789,14 @@ async def update_recipe(
     recipe: Recipe = Body(...),
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    recipe_dict = recipe.dict(exclude_unset=True)
-    recipe_dict.pop("id", None)
-    result = await db.recipes.update_one({"_id": ObjectId(recipe_id)}, {"$set": recipe_dict})
-    if result.matched_count == 0:
+    recipe_dict = recipe.model_dump(exclude={"id"}, exclude_unset=True)
+    updated = await db.recipes.find_one_and_update(
+        {"_id": ObjectId(recipe_id)}, {"$set": recipe_dict}, return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
         raise HTTPException(status_code=404, detail="Recipe not found")
-    updated = await db.recipes.find_one({"_id": ObjectId(recipe_id)})
-    return serialize_doc(updated)
+    invalidate_recipe_counts()
+    return MongoJSONResponse(updated)
 
 @app.delete("/api/recipes/{recipe_id}")
 async def delete_recipe(
@@ -496,26 +812,52 @@ async def delete_recipe(
     result = await db.recipes.delete_one({"_id": obj_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Recipe not found")
+    invalidate_recipe_counts()
     return {"detail": "Recipe deleted"}
 
 
 
 # Invoices
 from fastapi import Query
-from fastapi.responses import JSONResponse
 
 @app.get("/api/invoices")
 async def get_invoices(
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=1, le=100),
+    before_date: Optional[str] = None,
+    before_id: Optional[str] = None,
+    summary: bool = False,
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    total = await db.invoices.count_documents({})
-    invoices = await db.invoices.find().sort("date", -1).skip(skip).limit(limit).to_list(length=limit)
-    return JSONResponse({
-        "results": serialize_list(invoices),
-        "total": total
-    })
+    # Keyset pagination: pass the date and _id of the last invoice seen instead of a deep skip
+    query = {}
+    if bool(before_date) != bool(before_id):
+        raise HTTPException(
+            status_code=400, detail="before_date and before_id must be passed together"
+        )
+    if before_date and before_id:
+        try:
+            before_oid = ObjectId(before_id)
+        except InvalidId:
+            raise HTTPException(status_code=400, detail="Invalid before_id format")
+        query = {
+            "$or": [
+                {"date": {"$lt": before_date}},
+                {"date": before_date, "_id": {"$lt": before_oid}},
+            ]
+        }
+        skip = 0
+    projection = INVOICE_SUMMARY_PROJECTION if summary else None
+    cursor = (
+        db.invoices.find(query, projection)
+        .sort([("date", -1), ("_id", -1)])
+        .skip(skip)
+        .limit(limit)
+    )
+    total, invoices = await asyncio.gather(
+        count_matching(db.invoices, {}), cursor.to_list(length=limit)
+    )
+    return MongoJSONResponse({"results": invoices, "total": total})
 
 
 # --- INVOICE CREATION ENDPOINT ---
@@ -567,26 +909,24 @@ async def create_invoice(
             "anniversary": invoice.customerAnniversary or "",
         }
         result = await db.customers.insert_one(new_customer)
+        invalidate_customer_reads()
         customerId = str(result.inserted_id)
         customerName = invoice.customerName
 
     # Generate next invoice number (sequential, e.g., WHISK-01)
-    last_invoice = await db.invoices.find().sort("_id", -1).limit(1).to_list(1)
-    if last_invoice and "invoiceNumber" in last_invoice[0]:
-        try:
-            last_num = int(last_invoice[0]["invoiceNumber"].split("-")[-1])
-        except Exception:
-            last_num = 0
-    else:
-        last_num = 0
-    next_num = last_num + 1
-    invoice_number = f"WHISK-{next_num:02d}"
+    counter = await db.counters.find_one_and_update(
+        {"_id": "invoice"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    invoice_number = f"WHISK-{counter['seq']:02d}"
     invoice_doc = {
         "invoiceNumber": invoice_number,
         "customerId": customerId,
         "customerName": customerName,
         "date": invoice.date,
-        "items": [item.dict() for item in invoice.items],
+        "items": invoice.model_dump(include={"items"})["items"],
         "subtotal": invoice.subtotal,
         "discount": invoice.discount,
         "gst": invoice.gst,
@@ -595,10 +935,12 @@ async def create_invoice(
         "orderType": invoice.orderType,
         "notes": invoice.notes,
         "amountPaid": invoice.amountPaid,
+        # Marks invoices whose items were taken out of stock, see update_invoice
+        "stockApplied": True,
     }
-    result = await db.invoices.insert_one(invoice_doc)
-    saved_invoice = await db.invoices.find_one({"_id": result.inserted_id})
-    return serialize_doc(saved_invoice)
+    await db.invoices.insert_one(invoice_doc)
+    await apply_stock_movement([], invoice_doc["items"])
+    return MongoJSONResponse(invoice_doc)
 
 
 # --- INVOICE UPDATE ENDPOINT ---
@@ -610,6 +952,7 @@ async def update_invoice(
     invoice: InvoiceCreate = Body(...),
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
+    invoice_oid = ObjectId(invoice_id)
     # Handle customer: use existing or create new
     if invoice.customerId:
         customer = await db.customers.find_one({"_id": ObjectId(invoice.customerId)})
@@ -630,18 +973,16 @@ async def update_invoice(
             "anniversary": invoice.customerAnniversary or "",
         }
         result = await db.customers.insert_one(new_customer)
+        invalidate_customer_reads()
         customerId = str(result.inserted_id)
         customerName = invoice.customerName
 
-    # Preserve existing invoiceNumber
-    existing = await db.invoices.find_one({"_id": ObjectId(invoice_id)})
-    invoice_number = existing.get("invoiceNumber", "") if existing else ""
+    # invoiceNumber is left out of the $set so the existing number is preserved
     invoice_doc = {
-        "invoiceNumber": invoice_number,
         "customerId": customerId,
         "customerName": customerName,
         "date": invoice.date,
-        "items": [item.dict() for item in invoice.items],
+        "items": invoice.model_dump(include={"items"})["items"],
         "subtotal": invoice.subtotal,
         "discount": invoice.discount,
         "gst": invoice.gst,
@@ -651,11 +992,19 @@ async def update_invoice(
         "notes": invoice.notes,
         "amountPaid": invoice.amountPaid,
     }
-    result = await db.invoices.update_one({"_id": ObjectId(invoice_id)}, {"$set": invoice_doc})
-    if result.matched_count == 0:
+    # The pre-image comes back from the same atomic update, so concurrent edits can't
+    # both return the same old items to stock
+    existing = await db.invoices.find_one_and_update(
+        {"_id": invoice_oid}, {"$set": invoice_doc}, return_document=ReturnDocument.BEFORE
+    )
+    if existing is None:
         raise HTTPException(status_code=404, detail="Invoice not found")
-    updated_invoice = await db.invoices.find_one({"_id": ObjectId(invoice_id)})
-    return serialize_doc(updated_invoice)
+    # Invoices saved before stock tracking never took their items out, so editing one
+    # moves no stock and leaves it unmarked
+    if existing.get("stockApplied"):
+        await apply_stock_movement(existing.get("items", []), invoice_doc["items"])
+    updated_invoice = {"invoiceNumber": "", **existing, **invoice_doc}
+    return MongoJSONResponse(updated_invoice)
 
 # Record a stock purchase (add quantity and recalculate cost per unit)
 @app.post("/api/stock_items/{item_id}/purchases", response_model=StockItem)
@@ -664,24 +1013,38 @@ async def record_stock_purchase(
     purchase: StockPurchase = Body(...),
     current_user: Annotated[User, Depends(get_current_user)] = None
 ):
-    item = await db.stock_items.find_one({"_id": ObjectId(item_id)})
-    if not item:
-        raise HTTPException(status_code=404, detail="Stock item not found")
-    # Calculate new quantity
-    old_qty = item.get("quantity", 0)
-    old_cost = item.get("costPerUnit", 0)
+    item_oid = ObjectId(item_id)
     add_qty = purchase.quantity_added
     new_cost = purchase.cost_per_unit_of_purchase
-    # Weighted average cost calculation
-    if add_qty > 0:
-        total_qty = old_qty + add_qty
-        avg_cost = ((old_qty * old_cost) + (add_qty * new_cost)) / total_qty if total_qty > 0 else new_cost
-    else:
-        total_qty = old_qty
-        avg_cost = old_cost
-    await db.stock_items.update_one(
-        {"_id": ObjectId(item_id)},
-        {"$set": {"quantity": total_qty, "costPerUnit": avg_cost}}
+    if add_qty <= 0:
+        item = await db.stock_items.find_one({"_id": item_oid})
+        if not item:
+            raise HTTPException(status_code=404, detail="Stock item not found")
+        return MongoJSONResponse(item)
+    # Weighted average cost, computed by the server in the same atomic update
+    old_qty = {"$ifNull": ["$quantity", 0]}
+    old_cost = {"$ifNull": ["$costPerUnit", 0]}
+    total_qty = {"$add": [old_qty, add_qty]}
+    avg_cost = {
+        "$cond": [
+            {"$gt": [total_qty, 0]},
+            {"$divide": [{"$add": [{"$multiply": [old_qty, old_cost]}, add_qty * new_cost]}, total_qty]},
+            new_cost,
+        ]
+    }
+    updated = await db.stock_items.find_one_and_update(
+        {"_id": item_oid},
+        [{"$set": {"quantity": total_qty, "costPerUnit": avg_cost}}],
+        return_document=ReturnDocument.AFTER,
     )
-    updated = await db.stock_items.find_one({"_id": ObjectId(item_id)})
-    return serialize_doc(updated)
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Stock item not found")
+    invalidate_stock_reads()
+    return MongoJSONResponse(updated)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop and httptools come with uvicorn[standard]; name them so a missing one fails loudly
+    uvicorn.run("main:app", port=8000, loop="uvloop", http="httptools")
@@ -1,4 +1,5 @@
 # Script to add sequential invoiceNumber to all existing invoices in MongoDB
+# Numbering runs entirely on the server ($setWindowFields + $merge, MongoDB 5.0+)
 from pymongo import MongoClient
 
 MONGO_URI = "mongodb://localhost:27017/"
@@ -9,12 +10,33 @@ client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 collection = db[COLLECTION]
 
-# Fetch all invoices sorted by creation order (_id)
-invoices = list(collection.find().sort("_id", 1))
+# $setWindowFields needs MongoDB 5.0; check before touching any invoice
+if client.admin.command("buildInfo")["versionArray"] < [5]:
+    raise SystemExit("MongoDB 5.0 or newer is required to renumber invoices.")
 
-for idx, invoice in enumerate(invoices, start=1):
-    invoice_number = f"WHISK-{idx:02d}"
-    collection.update_one({"_id": invoice["_id"]}, {"$set": {"invoiceNumber": invoice_number}})
-    print(f"Updated invoice {_id} with invoiceNumber {invoice_number}")
+# Number invoices in creation order (_id) as WHISK-01, WHISK-02, ... into a staging
+# field first, so a failed aggregate leaves the existing numbers untouched
+seq = {"$toString": "$seq"}
+collection.aggregate([
+    {"$setWindowFields": {"sortBy": {"_id": 1}, "output": {"seq": {"$documentNumber": {}}}}},
+    {"$project": {
+        "newInvoiceNumber": {
+            "$concat": ["WHISK-", {"$cond": [{"$lt": ["$seq", 10]}, {"$concat": ["0", seq]}, seq]}]
+        },
+    }},
+    {"$merge": {"into": COLLECTION, "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}},
+])
 
-print("All invoices updated with invoiceNumber.")
+# Clear the old numbers before moving the new ones in, so renumbering never collides
+# with the unique index
+collection.update_many({}, {"$unset": {"invoiceNumber": ""}})
+collection.update_many(
+    {"newInvoiceNumber": {"$exists": True}},
+    [{"$set": {"invoiceNumber": "$newInvoiceNumber"}}, {"$unset": "newInvoiceNumber"}],
+)
+
+# Keep the API's invoice counter in step with the renumbered invoices
+total = collection.count_documents({})
+db.counters.update_one({"_id": "invoice"}, {"$set": {"seq": total}}, upsert=True)
+
+print(f"All {total} invoices updated with invoiceNumber.")